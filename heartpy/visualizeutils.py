@@ -2,10 +2,10 @@
 Functions that help visualize results
 '''
 
+import io
+import math
 import os
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
 import numpy as np
 
 from . import config
@@ -16,8 +16,19 @@ __all__ = ['plotter',
            'plot_breathing',
            'report']
 
+#time axes used by plotter, keyed by (number of samples, sample rate)
+_PLOTX_CACHE = {}
+_PLOTX_CACHE_SIZE = 8
+
+#signals longer than this are decimated by plotter unless specified otherwise
+_DECIMATE_MIN_SAMPLES = 50000
+
+#scatter plots with more points than this are rasterized in vector output
+_RASTERIZE_MIN_POINTS = 500
+
 def plotter(working_data, measures, show=True, figsize=None,
-            title='Heart Rate Signal Peak Detection', moving_average=False): # pragma: no cover
+            title='Heart Rate Signal Peak Detection', moving_average=False,
+            ax=None, decimate=None, _scratch=None): # pragma: no cover
     '''plots the analysis results.
 
     Function that uses calculated measures and data stored in the working_data{} and measures{}
@@ -50,6 +61,18 @@ def plotter(working_data, measures, show=True, figsize=None,
         The moving average is used for peak fitting.
         default: False
 
+    ax : matplotlib Axes object
+        existing axes to draw the plot on. When passed, no new figure is created
+        and figsize is ignored.
+        default : None
+
+    decimate : bool or None
+        whether to reduce the signal to the minimum and maximum value per
+        horizontal pixel before drawing. This speeds up plotting long signals
+        without visible difference. When None, signals longer than 50000
+        samples are decimated.
+        default : None
+
     Returns
     -------
     out : matplotlib plot object
@@ -79,42 +102,169 @@ def plotter(working_data, measures, show=True, figsize=None,
 
     # create plot x-var
     fs = working_data['sample_rate']
-    plotx = np.arange(0, len(working_data['hr'])/fs, 1/fs)
+    inv_fs = 1.0 / fs
+    plotx = _get_plotx(len(working_data['hr']), fs)
+
+    #peak positions in seconds, written to the scratch buffer if one is
+    #passed (by segment_plotter) and large enough
+    n_peaks = len(working_data['peaklist'])
+    n_rejected = len(working_data['removed_beats'])
+    if _scratch is not None and len(_scratch) >= n_peaks + n_rejected:
+        peaks_out = _scratch[:n_peaks]
+        rejected_out = _scratch[n_peaks:n_peaks + n_rejected]
+    else:
+        peaks_out = rejected_out = None
 
-    peaklist = working_data['peaklist']
+    peaklist = _scale(working_data['peaklist'], inv_fs, out=peaks_out)
     ybeat = working_data['ybeat']
-    rejectedpeaks = working_data['removed_beats']
+    rejectedpeaks = _scale(working_data['removed_beats'], inv_fs, out=rejected_out)
     rejectedpeaks_y = working_data['removed_beats_y']
 
-    fig, ax = plt.subplots(figsize=figsize)
+    if ax is None:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=figsize)
+    else:
+        fig = ax.figure
+
+    hr = working_data['hr']
+    rolling_mean = working_data['rolling_mean'] if moving_average else None
+
+    #reduce long signals to at most a few points per pixel column
+    if decimate is None:
+        decimate = len(hr) > _DECIMATE_MIN_SAMPLES
+    if decimate:
+        n_target = 4 * max(int(fig.get_figwidth() * fig.dpi), 1000)
+        if len(hr) > n_target:
+            n_bins = n_target // 2
+            hr_x, hr = _decimate_minmax(plotx, hr, n_bins)
+            if moving_average:
+                _, rolling_mean = _decimate_minmax(plotx, rolling_mean, n_bins)
+            plotx = hr_x
 
     ax.set_title(title)
-    ax.plot(plotx, working_data['hr'], color=colorpalette[0], label='heart rate signal', zorder=-10)
+    hr_line, = ax.plot(plotx, hr, color=colorpalette[0], label='heart rate signal', zorder=-10)
     ax.set_xlabel('Time (s)')
 
     if moving_average:
-        ax.plot(plotx, working_data['rolling_mean'], color='gray', alpha=0.5)
+        ax.plot(plotx, rolling_mean, color='gray', alpha=0.5)
+
+    rasterize = n_peaks > _RASTERIZE_MIN_POINTS
+    peaks_sc = ax.scatter(peaklist, ybeat, color=colorpalette[1], label='BPM:%.2f' %(measures['bpm']),
+                          rasterized=rasterize)
+    rejected_sc = ax.scatter(rejectedpeaks, rejectedpeaks_y, color=colorpalette[2], label='rejected peaks',
+                             rasterized=rasterize)
+
+    #mark rejected segments, if rejected segment detection was on.
+    #segments are stored as sample indices and drawn as a single collection
+    #spanning the full height of the axes
+    rejected_segments = working_data.get('rejected_segments', [])
+    if len(rejected_segments) >= 1:
+        from matplotlib.collections import PolyCollection
+        verts = [[(s0 * inv_fs, 0), (s0 * inv_fs, 1), (s1 * inv_fs, 1), (s1 * inv_fs, 0)]
+                 for s0, s1 in rejected_segments]
+        ax.add_collection(PolyCollection(verts, facecolor='red', alpha=0.5,
+                                         transform=ax.get_xaxis_transform()),
+                          autolim=False)
+
+    #pass handles explicitly, skips searching the axes for labelled artists
+    ax.legend(handles=[hr_line, peaks_sc, rejected_sc], loc='lower right', framealpha=0.6)
+
+    if show:
+        fig.show()
+    else:
+        return fig
+
+def _scale(arr, inv_fs, out=None):
+    '''returns arr multiplied by inv_fs as float array, written to out if passed
+
+    Helper function for plotter, converts sample indices to seconds.
+
+    Examples
+    --------
+    >>> _scale([0, 50, 100], 1.0 / 100.0)
+    array([0. , 0.5, 1. ])
+    '''
+    return np.multiply(np.asarray(arr, dtype=np.float64), inv_fs, out=out)
+
 
-    ax.scatter(np.asarray(peaklist)/fs, ybeat, color=colorpalette[1], label='BPM:%.2f' %(measures['bpm']))
-    ax.scatter(rejectedpeaks/fs, rejectedpeaks_y, color=colorpalette[2], label='rejected peaks')
+def _get_plotx(n, fs):
+    '''returns time axis for a signal of n samples at sample rate fs
 
-    #check if rejected segment detection is on and has rejected segments
+    Helper function for plotter. Axes are cached, so that plotting many
+    segments of equal length only builds the time axis once. The returned
+    array is read-only.
+    '''
+    key = (n, fs)
     try:
-        if len(working_data['rejected_segments']) >= 1:
-            for segment in working_data['rejected_segments']:
-                ax.axvspan(segment[0], segment[1], facecolor='red', alpha=0.5)
-    except:
+        return _PLOTX_CACHE[key]
+    except KeyError:
         pass
 
-    ax.legend(loc=4, framealpha=0.6)
+    plotx = np.arange(n, dtype=np.float64)
+    plotx /= float(fs)
+    plotx.flags.writeable = False
+
+    if len(_PLOTX_CACHE) >= _PLOTX_CACHE_SIZE:
+        _PLOTX_CACHE.clear()
+    _PLOTX_CACHE[key] = plotx
+    return plotx
+
+
+def _decimate_minmax(x, y, n_bins):
+    '''reduces signal to the minimum and maximum value of each bin
+
+    Helper function for plotter. Divides y in n_bins (or fewer) bins of
+    equal size and returns the minimum and maximum of each bin, interleaved,
+    at the x position where the bin starts. The last bin is padded with its
+    final value if needed.
+
+    Parameters
+    ----------
+    x : 1-d array
+        x-values of the signal
+
+    y : 1-d array
+        signal to decimate, same length as x
+
+    n_bins : int
+        number of bins to reduce the signal to
+
+    Returns
+    -------
+    x_dec : 1-d array
+        x-values of the decimated signal, two for each bin
+
+    y_dec : 1-d array
+        minimum and maximum value of each bin, interleaved
+
+    Examples
+    --------
+    >>> x, y = _decimate_minmax(np.arange(6), np.array([1, 3, 2, 5, 4, 0]), 2)
+    >>> x
+    array([0, 0, 3, 3])
+    >>> y
+    array([1, 3, 0, 5])
+    '''
+    y = np.asarray(y)
+    block = -(-len(y) // n_bins)
+    n_bins = -(-len(y) // block)
+
+    pad = n_bins * block - len(y)
+    if pad > 0:
+        y = np.concatenate((y, np.repeat(y[-1], pad)))
+    y = y.reshape(n_bins, block)
+
+    y_dec = np.empty(2 * n_bins, dtype=y.dtype)
+    y_dec[0::2] = y.min(axis=1)
+    y_dec[1::2] = y.max(axis=1)
+    x_dec = np.repeat(np.asarray(x)[::block], 2)
+
+    return x_dec, y_dec
 
-    if show:
-        fig.show()
-    else:
-        return fig
 
 def segment_plotter(working_data, measures, title='Heart Rate Signal Peak Detection',
-                    figsize=(6, 6), path='', start=0, end=None, step=1): # pragma: no cover
+                    figsize=(6, 6), path='', start=0, end=None, step=1,
+                    processes=1): # pragma: no cover
     '''plots analysis results
 
     Function that plots the results of segmentwise processing of heart rate signal
@@ -151,6 +301,11 @@ def segment_plotter(working_data, measures, title='Heart Rate Signal Peak Detect
         stepsize used when iterating over plots every step'th segment will be plotted
         default : 1
 
+    processes : int
+        number of worker processes used to render and write the plots. Segments
+        are independent, so they are divided evenly over the workers.
+        default : 1, plots in the calling process
+
     Returns
     -------
         None
@@ -176,7 +331,9 @@ def segment_plotter(working_data, measures, title='Heart Rate Signal Peak Detect
         if not os.path.isdir(path):
             os.makedirs(path)
 
-    #make plots
+    #collect segments to plot
+    rejected_segments = working_data.get('rejected_segments')
+    jobs = []
     filenum = 0
     for i in range(start, end, step):
         wd_segment = {}
@@ -188,19 +345,78 @@ def segment_plotter(working_data, measures, title='Heart Rate Signal Peak Detect
         wd_segment['removed_beats_y'] = working_data['removed_beats_y'][i]
         wd_segment['hr'] = working_data['hr'][i]
         wd_segment['rolling_mean'] = working_data['rolling_mean'][i]
+        wd_segment['sample_rate'] = working_data['sample_rate'][i]
         m_segment['bpm'] = measures['bpm'][i]
-        try:
-            wd_segment['rejected_segments'] = working_data['rejected_segments'][i]
-        except:
-            pass
-
-        #plot it using built-in plotter
-        plt.figure(figsize = figsize)
-        p = plotter(wd_segment, m_segment, show=False)
-        p.savefig('%s%i.png' %(path, filenum))
-        p.close()
+        if rejected_segments is not None:
+            wd_segment['rejected_segments'] = rejected_segments[i]
+
+        jobs.append((wd_segment, m_segment, '%s%i.png' %(path, filenum)))
         filenum += 1
 
+    #make plots
+    if processes > 1 and len(jobs) > 1:
+        import multiprocessing as mp
+        processes = min(processes, len(jobs))
+        pool = mp.Pool(processes)
+        try:
+            results = [pool.apply_async(_plot_segments, (jobs[n::processes], figsize, title))
+                       for n in range(processes)]
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _plot_segments(jobs, figsize, title)
+
+
+def _plot_segments(jobs, figsize, title): # pragma: no cover
+    '''writes segment plots to file
+
+    Helper function for segment_plotter. Renders each (working_data, measures,
+    filename) job in jobs on a single reused figure and saves it.
+    '''
+    #render straight to the Agg canvas, bypassing pyplot's figure manager
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from multiprocessing.pool import ThreadPool
+
+    #one figure is reused for all segments, cleared between iterations
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    #buffer for the peak positions, sized to the largest segment
+    n_scratch = max([len(wd['peaklist']) + len(wd['removed_beats'])
+                     for wd, _, _ in jobs] + [0])
+    scratch = np.empty(n_scratch, dtype=np.float64)
+
+    #encode each plot in memory and leave writing it to a background thread,
+    #so the next segment is rendered while the previous one goes to disk
+    writer = ThreadPool(1)
+    try:
+        results = []
+        for wd_segment, m_segment, filename in jobs:
+            #plot it using built-in plotter
+            ax.clear()
+            plotter(wd_segment, m_segment, show=False, title=title, ax=ax,
+                    _scratch=scratch)
+            buf = io.BytesIO()
+            fig.savefig(buf, format='png')
+            results.append(writer.apply_async(_write_file, (filename, buf.getvalue())))
+
+        for result in results:
+            result.get()
+    finally:
+        writer.close()
+        writer.join()
+
+
+def _write_file(filename, data): # pragma: no cover
+    '''writes bytes in data to filename, helper for _plot_segments'''
+    with open(filename, 'wb') as outfh:
+        outfh.write(data)
+
 
 def plot_poincare(working_data, measures, show = True, figsize=None,
                   title='Poincare plot'): # pragma: no cover
@@ -242,49 +458,52 @@ def plot_poincare(working_data, measures, show = True, figsize=None,
     #get color palette
     colorpalette = config.get_colorpalette_poincare()
 
-    #get values from dict
+    #get values from dict, x_plus and x_minus are 1-d arrays (see analysis.calc_poincare)
     x_plus = working_data['poincare']['x_plus']
     x_minus = working_data['poincare']['x_minus']
     sd1 = measures['sd1']
     sd2 = measures['sd2']
 
     #define figure
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
     fig, ax = plt.subplots(subplot_kw={'aspect': 'equal'}, figsize=figsize)
 
     #plot scatter
-    ax.scatter(x_plus, x_minus, color = colorpalette[0],
-                alpha = 0.75, label = 'peak-peak intervals')
+    intervals_sc = ax.scatter(x_plus, x_minus, color = colorpalette[0],
+                              alpha = 0.75, label = 'peak-peak intervals',
+                              rasterized = len(x_plus) > _RASTERIZE_MIN_POINTS)
 
     #plot identity line
-    mins = np.min([x_plus, x_minus])
-    maxs = np.max([x_plus, x_minus])
-    identity_line = np.linspace(np.min(mins), np.max(maxs))
-    ax.plot(identity_line, identity_line, color='black', alpha=0.5,
-             label = 'identity line')
+    lo = min(float(x_plus.min()), float(x_minus.min()))
+    hi = max(float(x_plus.max()), float(x_minus.max()))
+    identity_line = np.linspace(lo, hi)
+    identity_ln, = ax.plot(identity_line, identity_line, color='black', alpha=0.5,
+                           label = 'identity line')
 
     #rotate SD1, SD2 vectors 45 degrees counterclockwise
     sd1_xrot, sd1_yrot = rotate_vec(0, sd1, 45)
     sd2_xrot, sd2_yrot = rotate_vec(0, sd2, 45)
 
     #plot rotated SD1, SD2 lines
-    ax.plot([np.mean(x_plus), np.mean(x_plus) + sd1_xrot],
-             [np.mean(x_minus), np.mean(x_minus) + sd1_yrot],
-             color = colorpalette[1], label = 'SD1')
-    ax.plot([np.mean(x_plus), np.mean(x_plus) - sd2_xrot],
-             [np.mean(x_minus), np.mean(x_minus) + sd2_yrot],
-             color = colorpalette[2], label = 'SD2')
+    xmn = float(x_plus.mean())
+    ymn = float(x_minus.mean())
+    sd1_ln, = ax.plot([xmn, xmn + sd1_xrot],
+                      [ymn, ymn + sd1_yrot],
+                      color = colorpalette[1], label = 'SD1')
+    sd2_ln, = ax.plot([xmn, xmn - sd2_xrot],
+                      [ymn, ymn + sd2_yrot],
+                      color = colorpalette[2], label = 'SD2')
 
     #plot ellipse
-    xmn = np.mean(x_plus)
-    ymn = np.mean(x_minus)
-    el = Ellipse((xmn, ymn), width = sd2 * 2, height = sd1 * 2, angle = 45.0)
-    ax.add_artist(el)
-    el.set_edgecolor((0,0,0))
-    el.fill = False
+    el = Ellipse((xmn, ymn), width = sd2 * 2, height = sd1 * 2, angle = 45.0,
+                 edgecolor = (0,0,0), fill = False)
+    ax.add_patch(el)
 
     ax.set_xlabel('RRi_n (ms)')
     ax.set_ylabel('RRi_n+1 (ms)')
-    ax.legend(loc=4, framealpha=0.6)
+    ax.legend(handles=[intervals_sc, identity_ln, sd1_ln, sd2_ln],
+              loc='lower right', framealpha=0.6)
     ax.set_title(title)
 
     if show:
@@ -329,10 +548,10 @@ def rotate_vec(x, y, angle):
     >>> print('%.3f, %.3f' %(x_new, y_new))
     1.000, 0.000
     '''
-    theta = np.radians(angle)
+    theta = math.radians(angle)
 
-    cs = np.cos(theta)
-    sn = np.sin(theta)
+    cs = math.cos(theta)
+    sn = math.sin(theta)
 
     x_rot = (x * cs) - (y * sn)
     y_rot = (x * sn) + (y * cs)
@@ -373,8 +592,9 @@ def plot_breathing(working_data, measures, show=True, figsize=None): # pragma: n
     --------
     This function has no examples. See documentation of heartpy for more info.
     '''
+    import matplotlib.pyplot as plt
 
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=figsize)
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=figsize, constrained_layout=True)
 
     ax1.plot(working_data['breathing_signal'], label='breathing signal')
     ax1.set_xlabel('ms')
@@ -386,7 +606,6 @@ def plot_breathing(working_data, measures, show=True, figsize=None): # pragma: n
     ax2.set_title('spectrogram extracted from breathing rate signal')
 
     ax2.legend()
-    plt.tight_layout()
 
     if show:
         fig.show()
@@ -397,6 +616,7 @@ def plot_breathing(working_data, measures, show=True, figsize=None): # pragma: n
 def plot_psd(working_data, show=True, figsize=None):
     """Plot the RRi PSD produced by the frequency domain analysis.
     """
+    import matplotlib.pyplot as plt
 
     # plot the periodogram of RR intervals
     fig, ax = plt.subplots(figsize=figsize)
@@ -428,6 +648,33 @@ def plot_psd(working_data, show=True, figsize=None):
         return fig
 
 
+#measure labels with units, as used by report
+_LABEL_MAP = {'ibi': 'IBI (ms)',
+              'sdnn': 'SDNN (ms)',
+              'sdsd': 'SDSD (ms)',
+              'rmssd': 'RMSSD (ms)',
+              'pnn20': 'pNN20',
+              'pnn50': 'pNN50',
+              'hr_mad': 'HR_MAD (ms)',
+              'sd1': 'SD1 (ms)',
+              'sd2': 'SD2 (ms)',
+              's': 'S (ms^2)',
+              'vlf': 'VLF (ms^2)',
+              'lf': 'LF (ms^2)',
+              'hf': 'HF (ms^2)',
+              'p_total': 'P_total (ms^2)',
+              'vlf_perc': 'VLF %',
+              'lf_perc': 'LF %',
+              'hf_perc': 'HF %',
+              'lf_nu': 'LF (nu)',
+              'hf_nu': 'HF (nu)'}
+
+
+def _label_formatter(m):
+    '''returns formatted label with units for measure m, used by report'''
+    return _LABEL_MAP.get(m, m.upper())
+
+
 def report(working_data, measures, outfile=None, csvfile=False):
     '''Print info and measures in a readable format with units
 
@@ -438,50 +685,7 @@ def report(working_data, measures, outfile=None, csvfile=False):
     csvfile is True.
     '''
 
-    out_str = ""
-
-    # Formatted measures
-    def label_formatter(m):
-        if m == 'ibi':
-            return 'IBI (ms)'
-        elif m == 'sdnn':
-            return 'SDNN (ms)'
-        elif m == 'sdsd':
-            return 'SDSD (ms)'
-        elif m == 'rmssd':
-            return 'RMSSD (ms)'
-        elif m == 'pnn20':
-            return 'pNN20'
-        elif m == 'pnn50':
-            return 'pNN50'
-        elif m == 'hr_mad':
-            return 'HR_MAD (ms)'
-        elif m == 'sd1':
-            return 'SD1 (ms)'
-        elif m == 'sd2':
-            return 'SD2 (ms)'
-        elif m == 's':
-            return 'S (ms^2)'
-        elif m == 'vlf':
-            return 'VLF (ms^2)'
-        elif m == 'lf':
-            return 'LF (ms^2)'
-        elif m == 'hf':
-            return 'HF (ms^2)'
-        elif m == 'p_total':
-            return 'P_total (ms^2)'
-        elif m == 'vlf_perc':
-            return 'VLF %'
-        elif m == 'lf_perc':
-            return 'LF %'
-        elif m == 'hf_perc':
-            return 'HF %'
-        elif m == 'lf_nu':
-            return 'LF (nu)'
-        elif m == 'hf_nu':
-            return 'HF (nu)'
-        else:
-            return str.upper(m)
+    parts = []
 
     # header
     if csvfile:
@@ -489,8 +693,8 @@ def report(working_data, measures, outfile=None, csvfile=False):
     else:
         str_fmt = '{:<14} {:<15}\n'
 
-    out_str += str_fmt.format("Measure","Value")
-    out_str += str_fmt.format("-----------","---------")
+    parts.append(str_fmt.format("Measure","Value"))
+    parts.append(str_fmt.format("-----------","---------"))
 
     # table lines
     if csvfile:
@@ -498,23 +702,24 @@ def report(working_data, measures, outfile=None, csvfile=False):
     else:
         str_fmt = '{:<14} {:< #15.3g}\n'
 
-    for k, v in measures.items():
-        out_str += str_fmt.format(label_formatter(k), v)
+    parts.extend(str_fmt.format(_label_formatter(k), v) for k, v in measures.items())
 
     # Info
     if csvfile:
         str_fmt = '{},{:#0.3g}\n'
     else:
-        out_str += "\n"
+        parts.append("\n")
         str_fmt = '{:<14} {:< #15.3g}\n'
 
     best_ma = working_data['best']
-    out_str += str_fmt.format("Best MA (%)", best_ma)
+    parts.append(str_fmt.format("Best MA (%)", best_ma))
 
     n_rmbeats = len(working_data['removed_beats'])
     pc_rmbeats = 100*n_rmbeats/len(working_data['RR_list'])
-    out_str += str_fmt.format("Excl. peaks", n_rmbeats)
-    out_str += str_fmt.format("Excl. %", pc_rmbeats)
+    parts.append(str_fmt.format("Excl. peaks", n_rmbeats))
+    parts.append(str_fmt.format("Excl. %", pc_rmbeats))
+
+    out_str = "".join(parts)
 
     # print or write out
     if outfile is None: